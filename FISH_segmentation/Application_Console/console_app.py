@@ -29,29 +29,39 @@ def cli_argument_parser():
         dest='output',
         help='Name of output first table (.csv)',
         default="ouput.csv")
+    parser.add_argument(
+        '-e', '--export',
+        dest='export',
+        choices=['engine', 'onnx'],
+        help='Export the segmentation model once and use the export: engine (TensorRT, needs an NVIDIA GPU '
+             'and tensorrt) or onnx (needs onnx and onnxruntime). Falls back to the PyTorch model on failure',
+        default=None)
+    parser.add_argument(
+        '--compile',
+        dest='compile',
+        action='store_true',
+        help='Compile the segmentation model with torch.compile on GPU. Slow first image, pays off on many images')
     args = parser.parse_args()
 
     return args
 
 
 def rgba2rgb(rgba, background=(255, 255, 255)):
-    row, col, ch = rgba.shape
+    ch = rgba.shape[-1]
     if ch == 3:
         return rgba
     assert ch == 4, 'RGBA image has 4 channels.'
-    rgb = np.zeros((row, col, 3), dtype='float32')
-    r, g, b, a = rgba[:, :, 0], rgba[:, :, 1], rgba[:, :, 2], rgba[:, :, 3]
-    a = np.asarray(a, dtype='float32') / 255.0
-    R, G, B = background
-    rgb[:, :, 0] = r * a + (1.0 - a) * R
-    rgb[:, :, 1] = g * a + (1.0 - a) * G
-    rgb[:, :, 2] = b * a + (1.0 - a) * B
-    return np.asarray(rgb, dtype='uint8')
+    # Blend over the background in integers, uint16 holds 255 * 255 so no float temporaries are needed
+    alpha = rgba[..., 3:].astype(np.uint16)
+    rgb = rgba[..., :3] * alpha + np.array(background, dtype=np.uint16) * (255 - alpha)
+    return (rgb // 255).astype(np.uint8)
 
 
 if __name__ == '__main__':
     log.basicConfig(format='[%(levelname)s]:%(message)s', level=log.INFO)
     args = cli_argument_parser()
+    ChromosomeCellDetector.EXPORT_FORMAT = args.export
+    ChromosomeCellDetector.COMPILE = args.compile
     log.info(f'Read input image {args.input}')
 
     if args.input.endswith(".czi"):
@@ -30,6 +30,18 @@ def cli_argument_parser():
         dest='output',
         help='Name of output first table (.csv)',
         default="ouput.csv")
+    parser.add_argument(
+        '-e', '--export',
+        dest='export',
+        choices=['engine', 'onnx'],
+        help='Export the segmentation model once and use the export: engine (TensorRT, needs an NVIDIA GPU '
+             'and tensorrt) or onnx (needs onnx and onnxruntime). Falls back to the PyTorch model on failure',
+        default=None)
+    parser.add_argument(
+        '--compile',
+        dest='compile',
+        action='store_true',
+        help='Compile the segmentation model with torch.compile on GPU. Slow first image, pays off on many images')
 
     args = parser.parse_args()
 
@@ -37,18 +49,14 @@ def cli_argument_parser():
 
 
 def rgba2rgb(rgba, background=(255, 255, 255)):
-    row, col, ch = rgba.shape
+    ch = rgba.shape[-1]
     if ch == 3:
         return rgba
     assert ch == 4, 'RGBA image has 4 channels.'
-    rgb = np.zeros((row, col, 3), dtype='float32')
-    r, g, b, a = rgba[:, :, 0], rgba[:, :, 1], rgba[:, :, 2], rgba[:, :, 3]
-    a = np.asarray(a, dtype='float32') / 255.0
-    R, G, B = background
-    rgb[:, :, 0] = r * a + (1.0 - a) * R
-    rgb[:, :, 1] = g * a + (1.0 - a) * G
-    rgb[:, :, 2] = b * a + (1.0 - a) * B
-    return np.asarray(rgb, dtype='uint8')
+    # Blend over the background in integers, uint16 holds 255 * 255 so no float temporaries are needed
+    alpha = rgba[..., 3:].astype(np.uint16)
+    rgb = rgba[..., :3] * alpha + np.array(background, dtype=np.uint16) * (255 - alpha)
+    return (rgb // 255).astype(np.uint8)
 
 
 def find_images_by_extension(root_folder, extension):
@@ -61,124 +69,97 @@ def find_images_by_extension(root_folder, extension):
     return matches
 
 
-if __name__ == '__main__':
-    log.basicConfig(format='[%(levelname)s]:%(message)s', level=log.INFO)
-    args = cli_argument_parser()
+def read_image(image_path):
+    if image_path.suffix == ".czi":
+        image, _ = read_czi_image(image_path)
+        return image
 
-    log.info(f'Found all images in input directory: {args.input}')
+    image = mpimg.imread(image_path)
+    if image_path.suffix == ".png":
+        image = (255 * image).astype(np.uint8)  # normalize the data to 0-255
+        image = np.ascontiguousarray(image)
+        return rgba2rgb(image)
 
-    images_paths_czi = []
-    for file_path in Path(args.input).glob('**/*.czi'):
-        images_paths_czi.append(file_path)
-        log.info(f'Found image in czi format! Path: {file_path}')
+    return np.ascontiguousarray(image)
 
-    images_paths_png = []
-    for file_path in Path(args.input).glob('**/*.png'):
-        images_paths_png.append(file_path)
-        log.info(f'Found image in png format! Path: {file_path}')
 
-    images_paths_jpg = []
-    for file_path in Path(args.input).glob('**/*.jpg'):
-        images_paths_jpg.append(file_path)
-        log.info(f'Found image in jpg format! Path: {file_path}')
+def process_images(images_paths, folder_name, confidence, output, hide_axes=True):
+    folder_name_for_image_without_predict = f"..\\Photo_Console_Find_All\\{folder_name}\\Without_predict"
+    folder_name_for_image_with_predict = f"..\\Photo_Console_Find_All\\{folder_name}\\With_predict"
 
-    for image_path_czi in images_paths_czi:
-        try:
-            image, _ = read_czi_image(image_path_czi)
+    # Segment the images a batch at a time, so that the model gets the whole batch in a single predict call
+    batch_size = ChromosomeCellDetector.BATCH_SIZE
+    for start in range(0, len(images_paths), batch_size):
+        batch_paths, batch_names, detectors = [], [], []
+        for image_path in images_paths[start:start + batch_size]:
+            try:
+                image = read_image(image_path)
+            except Exception:
+                log.exception(f'Could not read the image! Path to image:{image_path}')
+                continue
 
-            folder_name_for_image_without_predict = "..\\Photo_Console_Find_All\\Photo_CZI\\Without_predict"
             if not os.path.exists(folder_name_for_image_without_predict):
                 os.makedirs(folder_name_for_image_without_predict)
-            Image_name = os.path.splitext(os.path.basename(image_path_czi))[0]
+            Image_name = os.path.splitext(os.path.basename(image_path))[0]
             plt.imsave(folder_name_for_image_without_predict + "\\" + Image_name + ".png", image)
 
-            detector = ChromosomeCellDetector(image)
-            log.info(f'{"Perform segmentation"}')
-            detector.find_cells(confidence=args.confidence)
+            batch_paths.append(image_path)
+            batch_names.append(Image_name)
+            detectors.append(ChromosomeCellDetector(image))
 
-            log.info(f'{"Perform chromosomes detection"}')
-            detector.detect_chromosomes()
-            log.info(f'{detector.GreenChromosome} Green Chromosome(s), {detector.RedChromosome} Red Chromosome(s)')
+        log.info(f'Perform segmentation of {len(detectors)} image(s)')
+        try:
+            ChromosomeCellDetector.find_cells_batch(detectors, confidence=confidence)
         except Exception:
-            log.exception(f'Open CV crashes on this image! Path to image:{image_path_czi}')
+            log.exception(f'Segmentation crashes on these images! Paths to images:{batch_paths}')
+            continue
 
-        fig, ax = plt.subplots(1, 1, figsize=(16, 16), dpi=300)
-        ax = detector.plot(ax)
-        fig.patch.set_visible(False)
-        ax.axis('off')
+        for image_path, Image_name, detector in zip(batch_paths, batch_names, detectors):
+            try:
+                log.info(f'{"Perform chromosomes detection"}')
+                detector.detect_chromosomes()
+                log.info(f'{detector.GreenChromosome} Green Chromosome(s), {detector.RedChromosome} Red Chromosome(s)')
+            except Exception:
+                log.exception(f'Open CV crashes on this image! Path to image:{image_path}')
 
-        folder_name_for_image_with_predict = "..\\Photo_Console_Find_All\\Photo_CZI\\With_predict"
-        if not os.path.exists(folder_name_for_image_with_predict):
-            os.makedirs(folder_name_for_image_with_predict)
-        fname = f'..\\Photo_Console_Find_All\\Photo_CZI\\With_predict\\{Image_name}.png'
-        fig.savefig(fname, dpi=300, format='png')
+            fig, ax = plt.subplots(1, 1, figsize=(16, 16), dpi=300)
+            ax = detector.plot(ax)
+            if hide_axes:
+                fig.patch.set_visible(False)
+                ax.axis('off')
 
-        log.info(f'{"Save information of prediction to .csv"}')
-        detector.write_to_csv(args.output, folder_name_for_image_with_predict, Image_name)
+            if not os.path.exists(folder_name_for_image_with_predict):
+                os.makedirs(folder_name_for_image_with_predict)
+            fname = f'{folder_name_for_image_with_predict}\\{Image_name}.png'
+            fig.savefig(fname, dpi=300, format='png')
 
-    for image_path_png in images_paths_png:
-        try:
-            image = mpimg.imread(image_path_png)
-            image = (255 * image).astype(np.uint8)  # normalize the data to 0-255
-            image = np.ascontiguousarray(image)
-            image = rgba2rgb(image)
-            folder_name_for_image_without_predict = "..\\Photo_Console_Find_All\\Photo_PNG\\Without_predict"
-            if not os.path.exists(folder_name_for_image_without_predict):
-                os.makedirs(folder_name_for_image_without_predict)
-            Image_name = os.path.splitext(os.path.basename(image_path_png))[0]
-            plt.imsave(folder_name_for_image_without_predict + "\\" + Image_name + ".png", image)
-            detector = ChromosomeCellDetector(image)
-            log.info(f'{"Perform segmentation"}')
-            detector.find_cells(confidence=args.confidence)
+            log.info(f'{"Save information of prediction to .csv"}')
+            detector.write_to_csv(output, folder_name_for_image_with_predict, Image_name)
 
-            log.info(f'{"Perform chromosomes detection"}')
-            detector.detect_chromosomes()
-            log.info(f'{detector.GreenChromosome} Green Chromosome(s), {detector.RedChromosome} Red Chromosome(s)')
-        except Exception:
-            log.exception(f'Open CV crashes on this image! Path to image:{image_path_png}')
-
-        fig, ax = plt.subplots(1, 1, figsize=(16, 16), dpi=300)
-        ax = detector.plot(ax)
-        fig.patch.set_visible(False)
-        ax.axis('off')
 
-        folder_name_for_image_with_predict = "..\\Photo_Console_Find_All\\Photo_PNG\\With_predict"
-        if not os.path.exists(folder_name_for_image_with_predict):
-            os.makedirs(folder_name_for_image_with_predict)
-        fname = f'..\\Photo_Console_Find_All\\Photo_PNG\\With_predict\\{Image_name}.png'
-        fig.savefig(fname, dpi=300, format='png')
+if __name__ == '__main__':
+    log.basicConfig(format='[%(levelname)s]:%(message)s', level=log.INFO)
+    args = cli_argument_parser()
+    ChromosomeCellDetector.EXPORT_FORMAT = args.export
+    ChromosomeCellDetector.COMPILE = args.compile
 
-        log.info(f'{"Save information of prediction to .csv"}')
-        detector.write_to_csv(args.output, folder_name_for_image_with_predict, Image_name)
+    log.info(f'Found all images in input directory: {args.input}')
 
-    for image_path_jpg in images_paths_jpg:
-        try:
-            image = mpimg.imread(image_path_jpg)
-            image = np.ascontiguousarray(image)
-            folder_name_for_image_without_predict = "..\\Photo_Console_Find_All\\Photo_JPG\\Without_predict"
-            if not os.path.exists(folder_name_for_image_without_predict):
-                os.makedirs(folder_name_for_image_without_predict)
-            Image_name = os.path.splitext(os.path.basename(image_path_jpg))[0]
-            plt.imsave(folder_name_for_image_without_predict + "\\" + Image_name + ".png", image)
-            detector = ChromosomeCellDetector(image)
-            log.info(f'{"Perform segmentation"}')
-            detector.find_cells(confidence=args.confidence)
-            log.info(f'{"Perform chromosomes detection"}')
-            detector.detect_chromosomes()
-            log.info(f'{detector.GreenChromosome} Green Chromosome(s), {detector.RedChromosome} Red Chromosome(s)')
-        except Exception:
-            log.exception(f'Open CV crashes on this image! Path to image:{image_path_jpg}')
+    images_paths_czi = []
+    for file_path in Path(args.input).glob('**/*.czi'):
+        images_paths_czi.append(file_path)
+        log.info(f'Found image in czi format! Path: {file_path}')
 
-        fig, ax = plt.subplots(1, 1, figsize=(16, 16), dpi=300)
-        ax = detector.plot(ax)
-        # fig.patch.set_visible(False)
-        # ax.axis('off')
+    images_paths_png = []
+    for file_path in Path(args.input).glob('**/*.png'):
+        images_paths_png.append(file_path)
+        log.info(f'Found image in png format! Path: {file_path}')
 
-        folder_name_for_image_with_predict = "..\\Photo_Console_Find_All\\Photo_JPG\\With_predict"
-        if not os.path.exists(folder_name_for_image_with_predict):
-            os.makedirs(folder_name_for_image_with_predict)
-        fname = f'..\\Photo_Console_Find_All\\Photo_JPG\\With_predict\\{Image_name}.png'
-        fig.savefig(fname, dpi=300, format='png')
+    images_paths_jpg = []
+    for file_path in Path(args.input).glob('**/*.jpg'):
+        images_paths_jpg.append(file_path)
+        log.info(f'Found image in jpg format! Path: {file_path}')
 
-        log.info(f'{"Save information of prediction to .csv"}')
-        detector.write_to_csv(args.output, folder_name_for_image_with_predict, Image_name)
+    process_images(images_paths_czi, "Photo_CZI", args.confidence, args.output)
+    process_images(images_paths_png, "Photo_PNG", args.confidence, args.output)
+    process_images(images_paths_jpg, "Photo_JPG", args.confidence, args.output, hide_axes=False)
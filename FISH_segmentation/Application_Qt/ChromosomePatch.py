@@ -1,14 +1,15 @@
 import enum
+import logging
 import os
 
 import cv2
-import imutils
 import numpy as np
-import scipy
-import skimage
-from matplotlib import pyplot as plt
+import torch
+from matplotlib.collections import EllipseCollection, LineCollection
 from ultralytics import YOLO
 
+logger = logging.getLogger(__name__)
+
 
 class Cell:
     @enum.unique
@@ -16,13 +17,23 @@ class Cell:
         EXPLODED = 0
         WHOLE = 1
 
-    def __init__(self, masked_area: np.ma.MaskedArray, cell_type: CellType):
-        self.masked_area = masked_area
+    def __init__(self, image: np.ndarray, mask2d: np.ndarray, cell_type: CellType):
+        # The image is shared by all cells of a detector, each cell keeps only its own 2-D mask
+        self.image = image
+        self.mask2d = mask2d
         self.cell_type = cell_type
+        # 0/1 mask of the cell area, bool and uint8 share the memory layout so view() avoids a copy
+        self.mask_u8 = mask2d.view(np.uint8)
 
         self.red_chromosomes = []
         self.green_chromosomes = []
 
+    @property
+    def masked_area(self) -> np.ma.MaskedArray:
+        # Built on demand, the 2-D mask is broadcast over the color channels as a view
+        outside_mask3d = np.broadcast_to(np.invert(self.mask2d)[..., np.newaxis], self.image.shape)
+        return np.ma.MaskedArray(self.image, mask=outside_mask3d, copy=False)
+
     def add_red_chromosome(self, red_chromosome):
         self.red_chromosomes.append(red_chromosome)
 
@@ -35,7 +46,17 @@ class ChromosomeCellDetector:
     GreenChromosome = 0
     MODEL_PATH = os.path.join(
         os.path.dirname(os.path.abspath(__file__)), "..\\Model\\my_yolov8_model_core_segmentation.pt")
-    CELLS_DETECTOR = YOLO(MODEL_PATH)
+    DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+    # Largest batch per predict call and of the exported engine. Not 16: ultralytics treats the default batch
+    # of 16 as unset and exports with a batch of 1
+    BATCH_SIZE = 8
+    # Optional export of the weights loaded instead of them: 'engine' (TensorRT, NVIDIA GPU) or 'onnx' (ONNX Runtime)
+    EXPORT_FORMAT = None
+    CELLS_DETECTOR = None
+    # Compile the PyTorch network with torch.compile on GPU. Pays off only when many images are processed
+    COMPILE = False
+    # Original network of the detector while a torch.compile'd one is in use
+    EAGER_NETWORK = None
 
     def __init__(self, image: np.ndarray):
         self.image: np.ndarray = image
@@ -44,149 +65,280 @@ class ChromosomeCellDetector:
     def plot(self, ax=None):
         ax.imshow(self.image)
 
+        # Gather everything first and draw one collection per color instead of one artist per contour/chromosome
+        contours = {'green': [], 'red': []}
+        chromosomes = {'red': [], 'green': []}
         for cell in self.cells:
-            mask = np.invert(cell.masked_area.mask[..., 0]).astype(np.uint8)
             contour_color = 'green' if cell.cell_type == Cell.CellType.WHOLE else 'red'
-            ax.contour(mask, colors=contour_color, linewidths=0.5, alpha=0.5)
+            cell_contours, _ = cv2.findContours(cell.mask_u8, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+            # Repeat the first point so that every outline is closed
+            contours[contour_color].extend(np.concatenate([c[:, 0], c[:1, 0]]) for c in cell_contours)
+
+            chromosomes['red'].extend(cell.red_chromosomes)
+            chromosomes['green'].extend(cell.green_chromosomes)
+
+        for color, lines in contours.items():
+            ax.add_collection(LineCollection(lines, colors=color, linewidths=0.5, alpha=0.5), autolim=False)
+
+        for color, points in chromosomes.items():
+            if not points:
+                continue
+            # Circles of radius 3 in image pixels, points are (row, col) so swap them to (x, y)
+            circles = EllipseCollection(
+                widths=6,
+                heights=6,
+                angles=0,
+                units='xy',
+                offsets=np.array(points)[:, ::-1],
+                offset_transform=ax.transData,
+                facecolors='none',
+                edgecolors=color,
+                linestyles='--')
+            ax.add_collection(circles, autolim=False)
 
-            for p in cell.red_chromosomes:
-                circle = plt.Circle((p[1], p[0]), radius=3, color='red', fill=False, linestyle='--')
-                ax.add_patch(circle)
-
-            for p in cell.green_chromosomes:
-                circle = plt.Circle((p[1], p[0]), radius=3, color='green', fill=False, linestyle='--')
-                ax.add_patch(circle)
         return ax
 
     def rgba2rgb(self, rgba, background=(255, 255, 255)):
-        row, col, ch = rgba.shape
+        ch = rgba.shape[-1]
         if ch == 3:
             return rgba
         assert ch == 4, 'RGBA image has 4 channels.'
-        rgb = np.zeros((row, col, 3), dtype='float32')
-        r, g, b, a = rgba[:, :, 0], rgba[:, :, 1], rgba[:, :, 2], rgba[:, :, 3]
-        a = np.asarray(a, dtype='float32') / 255.0
-        R, G, B = background
-        rgb[:, :, 0] = r * a + (1.0 - a) * R
-        rgb[:, :, 1] = g * a + (1.0 - a) * G
-        rgb[:, :, 2] = b * a + (1.0 - a) * B
-        return np.asarray(rgb, dtype='uint8')
+        # Blend over the background in integers, uint16 holds 255 * 255 so no float temporaries are needed
+        alpha = rgba[..., 3:].astype(np.uint16)
+        rgb = rgba[..., :3] * alpha + np.array(background, dtype=np.uint16) * (255 - alpha)
+        return (rgb // 255).astype(np.uint8)
+
+    @classmethod
+    def __get_model(cls):
+        if cls.CELLS_DETECTOR is None:
+            model = cls.__load_exported_model() if cls.EXPORT_FORMAT else None
+            if model is None:
+                model = YOLO(cls.MODEL_PATH)
+                cls.__warm_up(model)
+                cls.__compile(model)
+            cls.CELLS_DETECTOR = model
+
+        return cls.CELLS_DETECTOR
+
+    @classmethod
+    def __load_exported_model(cls):
+        # Exported once next to the weights and reused afterwards. Any failure to export, load or run the export
+        # (missing runtime, engine built for another TensorRT or GPU, broken file) falls back to the PyTorch weights
+        exported_path = f'{os.path.splitext(cls.MODEL_PATH)[0]}.{cls.EXPORT_FORMAT}'
+        exported_now = False
+        try:
+            if not os.path.isfile(exported_path):
+                exported_now = True
+                YOLO(cls.MODEL_PATH).export(
+                    format=cls.EXPORT_FORMAT,
+                    half=cls.DEVICE != 'cpu',
+                    dynamic=True,
+                    batch=cls.BATCH_SIZE,
+                    device=cls.DEVICE,
+                )
+            # Exported files carry no task, tell it explicitly
+            model = YOLO(exported_path, task='segment')
+            cls.__warm_up(model)
+        except Exception:
+            logger.warning(f"Exported cell detector {exported_path} is unusable, using PyTorch weights", exc_info=True)
+            # Do not keep a broken export of this run as cache, the next run exports it again. An export made
+            # earlier is kept: it may only fail in this environment (missing runtime, out of memory)
+            if exported_now and os.path.isfile(exported_path):
+                os.remove(exported_path)
+            return None
+
+        return model
+
+    @classmethod
+    def __warm_up(cls, model: YOLO):
+        # Run once so the first real image does not pay for the predictor setup.
+        # Half precision is ignored by ultralytics on CPU
+        model.predict(np.zeros((640, 640, 3), dtype=np.uint8), half=True, device=cls.DEVICE, verbose=False)
+
+    @classmethod
+    def __compile(cls, model: YOLO):
+        # The predictor wraps the network in its backend, compile the network inside it so the wrapper stays intact
+        backend = model.predictor.model
+
+        # CUDA graphs of the 'reduce-overhead' mode only pay off on GPU, torch.compile needs PyTorch 2
+        if not cls.COMPILE or cls.DEVICE == 'cpu' or not hasattr(torch, 'compile'):
+            return
+
+        network = backend.model
+        try:
+            # Real images come letterboxed to various shapes and batch sizes, dynamic shapes avoid a recompile each
+            backend.model = torch.compile(network, mode='reduce-overhead', fullgraph=False, dynamic=True)
+            # Compilation is lazy, trigger it now instead of on the first real image
+            cls.__warm_up(model)
+            cls.EAGER_NETWORK = network
+        except Exception:
+            logger.warning("torch.compile is not available for the cell detector, running in eager mode", exc_info=True)
+            backend.model = network
+
+    @classmethod
+    def __predict(cls, images: list[np.ndarray], confidence: float):
+        model = cls.__get_model()
+        exported = not model.predictor.model.pt
+        if exported and len(images) == 3:
+            # Ultralytics picks the mask prototypes by len(preds[1]) == 3, which for exported models is the batch
+            # size, so a batch of exactly three images breaks postprocessing. Split it into two calls
+            return cls.__predict(images[:2], confidence) + cls.__predict(images[2:], confidence)
+
+        def predict(model: YOLO):
+            return model.predict(
+                images,
+                classes=[0, 1],
+                conf=confidence,
+                batch=len(images),
+                half=True,
+                device=cls.DEVICE,
+                retina_masks=True,
+                verbose=False,
+            )
+
+        try:
+            return predict(model)
+        except Exception as error:
+            if exported:
+                logger.warning("Exported cell detector failed, switching to PyTorch weights", exc_info=True)
+                cls.EXPORT_FORMAT = None
+                cls.CELLS_DETECTOR = None
+                model = cls.__get_model()
+            # A new input shape may recompile the network, which the warm-up could not check in advance.
+            # Only compilation errors switch to eager mode, anything else (e.g. out of memory) is not its fault
+            elif cls.EAGER_NETWORK is not None and isinstance(error, torch._dynamo.exc.TorchDynamoException):
+                logger.warning("torch.compile failed on a new input shape, running the cell detector in eager mode",
+                               exc_info=True)
+                model.predictor.model.model = cls.EAGER_NETWORK
+                cls.EAGER_NETWORK = None
+            else:
+                raise
+            return predict(model)
 
     def find_cells(self, confidence: float = 0.5):
+        return ChromosomeCellDetector.find_cells_batch([self], confidence=confidence)[0]
+
+    @classmethod
+    def find_cells_batch(cls, detectors: list['ChromosomeCellDetector'], confidence: float = 0.5):
+        # Run the images through the model in batches instead of one predict call per image.
+        # Batches are capped at BATCH_SIZE, the largest batch an exported engine accepts
+        cell_counts = []
+        for start in range(0, len(detectors), cls.BATCH_SIZE):
+            batch = detectors[start:start + cls.BATCH_SIZE]
+            predictions = cls.__predict([detector.image for detector in batch], confidence)
+
+            cell_counts.extend(detector.__add_cells(prediction) for detector, prediction in zip(batch, predictions))
+
+        return cell_counts
+
+    def __add_cells(self, prediction):
         if self.cells:
             self.cells.clear()
 
-        predictions = ChromosomeCellDetector.CELLS_DETECTOR.predict(
-            self.image.copy(),
-            classes=[0, 1],
-            conf=confidence,
-        )
-
-        for prediction in predictions:
-            masks = prediction.masks.data.numpy().transpose(1, 2, 0)
-            classes = prediction.boxes.cls.data.numpy()
-
-            for mask, cls in zip(np.rollaxis(masks, 2), classes):
-                mask = cv2.resize(mask, dsize=self.image.shape[:2], interpolation=cv2.INTER_LINEAR)
-                mask3d = (np.repeat(mask[..., np.newaxis], 3, axis=-1) > 0).astype(bool)
-
-                # TODO: opencv and skimage give slightly different resized mask
-                # mask = skimage.transform.resize(
-                #     mask.astype(bool),
-                #     output_shape=self.image.shape[:2],
-                #     order=0,
-                #     preserve_range=True,
-                #     anti_aliasing=False
-                # )
-                # mask3d = np.repeat(mask[..., np.newaxis], 3, axis=-1)
-
-                masked_image = np.ma.masked_where(np.invert(mask3d), self.image)
-
-                cell = Cell(masked_image, Cell.CellType(int(cls)))
-                self.cells.append(cell)
-        # Доп.Информация:
-        names = ChromosomeCellDetector.CELLS_DETECTOR.names
+        # Images without detections have no masks at all
+        if prediction.masks is None:
+            return 0, 0
+
+        # Masks already come at the image resolution (retina_masks), threshold them on the device and copy once
+        masks = (prediction.masks.data > 0).cpu().numpy()
+        classes = prediction.boxes.cls.cpu().numpy()
+
+        # Доп.Информация: cells of each type are counted while they are created
         number_whole = 0
         number_explode = 0
-        for r in predictions:
-            for c in r.boxes.cls:
-                if names[int(c)] == "Whole cell":
-                    number_whole += 1
-                if names[int(c)] == "Explode cell":
-                    number_explode += 1
-        print("Explode:")
-        print(number_explode)
-        print("Whole:")
-        print(number_whole)
+        for mask, cls in zip(masks, classes):
+            cell = Cell(self.image, mask, Cell.CellType(int(cls)))
+            self.cells.append(cell)
+            number_whole += cell.cell_type == Cell.CellType.WHOLE
+            number_explode += cell.cell_type == Cell.CellType.EXPLODED
+
+        logger.debug(f"Explode: {number_explode}, Whole: {number_whole}")
         return number_explode, number_whole
 
     def detect_chromosomes(self):
         unsharped_image = ChromosomeCellDetector.__unsharp_mask(self.image,
-                                                                kernel_size=(5, 5),
                                                                 sigma=5.0,
                                                                 amount=5.0,
                                                                 threshold=100)
-        red_channel, green_channel = unsharped_image[..., 0], unsharped_image[..., 1]
+        red_green_channels = np.ascontiguousarray(unsharped_image[..., :2])
 
-        red_chromosome_candidates = ChromosomeCellDetector.__get_chromosome_candidates(red_channel)
-        green_chromosome_candidates = ChromosomeCellDetector.__get_chromosome_candidates(green_channel)
+        red_chromosome_candidates, green_chromosome_candidates = ChromosomeCellDetector.__get_chromosome_candidates(
+            red_green_channels)
+
+        # The cell distance maps dominate the cost, so look up both colors in a single pass over the cells
+        distances = self.__get_border_distances(np.concatenate([red_chromosome_candidates,
+                                                                green_chromosome_candidates]))
+        red_distances, green_distances = np.split(distances, [red_chromosome_candidates.shape[0]], axis=1)
 
         closeness = 1.0
         ChromosomeCellDetector.RedChromosome = 0
         ChromosomeCellDetector.GreenChromosome = 0
         self.__filter_chromosomes(
             red_chromosome_candidates,
+            red_distances,
             'red',
             closeness=closeness)
         self.__filter_chromosomes(
             green_chromosome_candidates,
+            green_distances,
             'green',
             closeness=closeness)
 
+    def __get_border_distances(self, chromosome_candidates: np.ndarray):
+        rows, cols = np.rint(chromosome_candidates).astype(int).T
+
+        # Distance from each candidate to the border of each cell, shape (cells, candidates). With the precise
+        # metric pixels on the border get exactly 1, so shift by one to match pointPolygonTest: zero on the border
+        distances = np.empty((len(self.cells), chromosome_candidates.shape[0]), dtype=np.float32)
+        for cell_idx, cell in enumerate(self.cells):
+            # distanceTransform does not treat pixels outside the image as background, pad the mask with one so
+            # that cells cut off by the image frame get their border on the frame, as with pointPolygonTest
+            padded_mask = cv2.copyMakeBorder(cell.mask_u8, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+            distance_map = cv2.distanceTransform(padded_mask, cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            distances[cell_idx] = distance_map[rows + 1, cols + 1] - 1.0
+
+        return distances
+
     def __filter_chromosomes(
             self,
             chromosome_candidates: np.ndarray,
+            distances: np.ndarray,
             chromosome_type: str,
             closeness: float = 1.0):
-        accepted = np.zeros(chromosome_candidates.shape[0], dtype=bool)
-
-        for idx, candidate in enumerate(chromosome_candidates):
-            for cell in self.cells:
-                mask = np.invert(cell.masked_area.mask[..., 0]).astype(np.uint8)
-
-                # TODO: to fix, sometimes opencv on certain images crashes (IDGAF why)
-                contour = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
-                contour = imutils.grab_contours(contour)[0]
-
-                distance = cv2.pointPolygonTest(contour, candidate[::-1], measureDist=True)
-                inside_cell = distance > 0.0
-                almost_on_cell_border = distance <= closeness
-
-                if not accepted[idx] and inside_cell and not almost_on_cell_border:
-                    accepted[idx] = True
-                    if chromosome_type == 'red':
-                        cell.add_red_chromosome(candidate)
-                        ChromosomeCellDetector.RedChromosome += 1
-                    elif chromosome_type == 'green':
-                        cell.add_green_chromosome(candidate)
-                        ChromosomeCellDetector.GreenChromosome += 1
-                    break
+        if not self.cells:
+            return
+
+        inside_cell = distances > 0.0
+        almost_on_cell_border = distances <= closeness
+        suitable = inside_cell & ~almost_on_cell_border
+
+        # Each candidate belongs to the first cell it fits in
+        accepted = suitable.any(axis=0)
+        owners = suitable.argmax(axis=0)
+
+        for candidate, cell_idx in zip(chromosome_candidates[accepted], owners[accepted]):
+            cell = self.cells[cell_idx]
+            if chromosome_type == 'red':
+                cell.add_red_chromosome(candidate)
+                ChromosomeCellDetector.RedChromosome += 1
+            elif chromosome_type == 'green':
+                cell.add_green_chromosome(candidate)
+                ChromosomeCellDetector.GreenChromosome += 1
 
     @staticmethod
     def __unsharp_mask(
             image: np.ndarray,
-            kernel_size: tuple[int, int] = (5, 5),
-            sigma: float = 0.0,
+            sigma: float,
+            kernel_size: tuple[int, int] = (0, 0),
             amount: float = 1.0,
             threshold: int = 0):
-        blurred = cv2.GaussianBlur(image, kernel_size, sigma)
-        sharpened = float(amount + 1) * image - float(amount) * blurred
-        sharpened = np.maximum(sharpened, np.zeros(sharpened.shape))
-        sharpened = np.minimum(sharpened, 255 * np.ones(sharpened.shape))
-        sharpened = sharpened.round().astype(np.uint8)
+        # With kernel_size (0, 0) OpenCV derives the kernel from sigma instead of truncating it
+        blurred = cv2.GaussianBlur(image, kernel_size, sigmaX=sigma, borderType=cv2.BORDER_REPLICATE)
+        # (amount + 1) * image - amount * blurred, rounded and saturated to uint8 in a single pass
+        sharpened = cv2.addWeighted(image, amount + 1.0, blurred, -amount, 0, dtype=cv2.CV_8U)
 
         if threshold > 0:
-            low_contrast_mask = np.absolute(image - blurred) < threshold
+            low_contrast_mask = cv2.absdiff(image, blurred) < threshold
             np.copyto(sharpened, image, where=low_contrast_mask)
 
         return sharpened
@@ -196,9 +348,14 @@ class ChromosomeCellDetector:
         kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
         morph_type = cv2.MORPH_GRADIENT
 
+        # Threshold and morphology handle all channels in one pass, only the labeling is done per channel
         _, thresh = cv2.threshold(image, 100, 255, cv2.THRESH_BINARY)
         morph = cv2.morphologyEx(thresh, morph_type, kernel)
-        labels, num_labels = skimage.measure.label(morph, background=0, return_num=True, connectivity=1)
-        points = scipy.ndimage.center_of_mass(labels, labels, range(1, num_labels + 1))
 
-        return np.array(points)
+        candidates = []
+        for channel in cv2.split(morph):
+            _, _, _, centroids = cv2.connectedComponentsWithStats(channel, connectivity=4, ltype=cv2.CV_32S)
+            # Skip the background component and swap (x, y) to (row, col)
+            candidates.append(centroids[1:, ::-1])
+
+        return candidates